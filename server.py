@@ -1,5 +1,8 @@
 import flwr as fl
 import argparse
+import json
+import os
+import shutil
 
 from typing import List, Tuple
 from pathlib import Path
@@ -11,6 +14,7 @@ from torchvision.models import mobilenet_v3_small
 from torch.utils.data import DataLoader
 from torchvision.transforms import Compose, Normalize, ToTensor
 
+from safetensors.torch import save_file
 from tqdm import tqdm
 
 
@@ -72,49 +76,50 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
 
+# CIFAR-10 class labels
+CIFAR10_LABELS = {
+    0: "airplane",
+    1: "automobile",
+    2: "bird",
+    3: "cat",
+    4: "deer",
+    5: "dog",
+    6: "frog",
+    7: "horse",
+    8: "ship",
+    9: "truck",
+}
+
 
 def test(model: nn.Module, testloader: DataLoader, device: torch.device):
     """Evaluate the model on the test set."""
-    # CIFAR-10 class labels
-    cifar10_labels = {
-        0: "airplane",
-        1: "automobile",
-        2: "bird",
-        3: "cat",
-        4: "deer",
-        5: "dog",
-        6: "frog",
-        7: "horse",
-        8: "ship",
-        9: "truck",
-    }
-
     model.eval()
-    running_loss = 0.0
-    class_correct = torch.zeros(10)
-    class_total = torch.zeros(10)
-    prediction_distribution = torch.zeros(10)
+    # Accumulate on the eval device and copy to the host once after the loop.
+    # Rows of stats: per-class sample count, per-class correct, per-class predictions
+    running_loss = torch.zeros((), device=device)
+    stats = torch.zeros(3, 10, device=device)
 
     criterion = nn.CrossEntropyLoss()
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for data in tqdm(testloader, desc="Server-side Testing"):
-            inputs, labels = data["img"].to(device), data["label"].to(device)
+            inputs = data["img"].to(device, non_blocking=True)
+            labels = data["label"].to(device, non_blocking=True)
             outputs = model(inputs)
             loss = criterion(outputs, labels)
 
             _, predicted = outputs.max(1)
 
-            for pred in predicted:
-                prediction_distribution[pred] += 1
-
-            for label, prediction in zip(labels, predicted):
-                class_total[label] += 1
-                if label == prediction:
-                    class_correct[label] += 1
+            stats[0].scatter_add_(0, labels, torch.ones_like(labels, dtype=torch.float))
+            stats[1].scatter_add_(0, labels, (predicted == labels).float())
+            stats[2].scatter_add_(
+                0, predicted, torch.ones_like(predicted, dtype=torch.float)
+            )
 
-            running_loss += loss.item()
+            running_loss += loss
 
+    class_total, class_correct, prediction_distribution = stats.cpu()
+    running_loss = running_loss.item()
     overall_accuracy = class_correct.sum() / class_total.sum() * 100
     avg_loss = running_loss / len(testloader)
 
@@ -132,7 +137,7 @@ def test(model: nn.Module, testloader: DataLoader, device: torch.device):
         accuracy = (
             (class_correct[i] / class_total[i] * 100) if class_total[i] > 0 else 0
         )
-        class_name = f"Class {i} ({cifar10_labels[i]})"
+        class_name = f"Class {i} ({CIFAR10_LABELS[i]})"
         print(
             f"{class_name:<20} | {class_total[i]:8.0f} | {class_correct[i]:8.0f} | {accuracy:9.2f}%"
         )
@@ -144,7 +149,7 @@ def test(model: nn.Module, testloader: DataLoader, device: torch.device):
     total_predictions = prediction_distribution.sum()
     for i in range(10):
         percentage = (prediction_distribution[i] / total_predictions) * 100
-        class_name = f"Class {i} ({cifar10_labels[i]})"
+        class_name = f"Class {i} ({CIFAR10_LABELS[i]})"
         print(
             f"{class_name:<20} | {prediction_distribution[i]:12.0f} | {percentage:9.2f}%"
         )
@@ -153,7 +158,7 @@ def test(model: nn.Module, testloader: DataLoader, device: torch.device):
     class_accuracies = {}
     for i in range(10):
         acc = (class_correct[i] / class_total[i] * 100) if class_total[i] > 0 else 0
-        class_accuracies[f"class_{i}_{cifar10_labels[i]}_acc"] = float(acc)
+        class_accuracies[f"class_{i}_{CIFAR10_LABELS[i]}_acc"] = float(acc)
 
     metrics = {
         "accuracy": float(overall_accuracy),
@@ -165,26 +170,44 @@ def test(model: nn.Module, testloader: DataLoader, device: torch.device):
     return avg_loss, overall_accuracy, metrics
 
 
+test_transforms = Compose(
+    [ToTensor(), Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]
+)
+
+
+def apply_test_transforms(batch):
+    """Apply transforms to the dataset (module-level so DataLoader workers can pickle it)."""
+    batch["img"] = [test_transforms(img) for img in batch["img"]]
+    return batch
+
+
 def prepare_test_dataset():
     """Prepare the test dataset for server-side evaluation."""
     from flwr_datasets import FederatedDataset
 
-    img_key = "img"
-    norm = Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    pytorch_transforms = Compose([ToTensor(), norm])
-
-    def apply_transforms(batch):
-        """Apply transforms to the dataset."""
-        batch[img_key] = [pytorch_transforms(img) for img in batch[img_key]]
-        return batch
-
     # Load and transform the test set
     fds = FederatedDataset(dataset="cifar10", partitioners={"train": 50})
     testset = fds.load_split("test")
-    testset = testset.with_transform(apply_transforms)
+    testset = testset.with_transform(apply_test_transforms)
     return testset
 
 
+def prepare_test_loader(device: torch.device) -> DataLoader:
+    """Build a DataLoader that decodes/normalizes test images in worker processes."""
+    num_workers = (os.cpu_count() or 1) // 2
+    # Workers are kept alive across rounds and prefetch ahead of the forward pass
+    worker_kwargs = (
+        {"persistent_workers": True, "prefetch_factor": 4} if num_workers > 0 else {}
+    )
+    return DataLoader(
+        prepare_test_dataset(),
+        batch_size=256,
+        num_workers=num_workers,
+        pin_memory=device.type == "cuda",
+        **worker_kwargs,
+    )
+
+
 class SaveModelStrategy(fl.server.strategy.FedAvg):
     """Custom strategy that saves the model after training."""
 
@@ -198,6 +221,8 @@ class SaveModelStrategy(fl.server.strategy.FedAvg):
         super().__init__(*args, **kwargs)
         self.save_dir = Path(save_dir)  # Directory for saving models
         self.save_dir.mkdir(exist_ok=True, parents=True)  # Ensure the directory exists
+        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.testloader = None  # Built on first use and reused every round
 
     def aggregate_fit(
         self,
@@ -222,47 +247,59 @@ class SaveModelStrategy(fl.server.strategy.FedAvg):
         )
 
         if aggregated_parameters is not None:
-            # Convert aggregated parameters to PyTorch state_dict
-            parameters_dict = dict(
-                zip(
-                    model.state_dict().keys(),
+            # Convert aggregated parameters to PyTorch state_dict without copying the arrays
+            reference_state = model.state_dict()
+            state_dict = {
+                k: torch.from_numpy(v)
+                for k, v in zip(
+                    reference_state.keys(),
                     fl.common.parameters_to_ndarrays(aggregated_parameters),
                 )
-            )
-
-            # Evaluate the aggregated model on the test set
-            testset = prepare_test_dataset()
-            testloader = DataLoader(testset, batch_size=64, num_workers=0)
-            loss, accuracy, metrics = test(
-                model, testloader, device=torch.device("cpu")
-            )
+            }
+
+            # Store floating point tensors as bfloat16 to halve the checkpoint size,
+            # restoring integer buffers (e.g. num_batches_tracked) to their own dtype
+            parameters_dict = {
+                k: v.to(torch.bfloat16)
+                if reference_state[k].is_floating_point()
+                else v.to(reference_state[k].dtype)
+                for k, v in state_dict.items()
+            }
+
+            # Evaluate the aggregated model on the test set; the server model still holds
+            # the initial weights until the aggregated ones are loaded into it. Load the
+            # bfloat16-rounded tensors so the metrics describe the weights that are saved
+            if self.testloader is None:
+                self.testloader = prepare_test_loader(self.device)
+            model.load_state_dict(parameters_dict)
+            model.to(self.device)
+            loss, accuracy, metrics = test(model, self.testloader, device=self.device)
 
             print("\n" + "=" * 50)
             print(f"ROUND {server_round} COMPLETE")
             print("=" * 50)
 
-            # Save the model after aggregation
-            save_path = self.save_dir / f"model_round_{server_round}.pt"
-            torch.save(
-                {
-                    "round": server_round,
-                    "model_state_dict": parameters_dict,
-                    "metrics": metrics,
-                },
-                save_path,
+            # Save the model after aggregation (safetensors can be memory-mapped on load)
+            save_path = self.save_dir / f"model_round_{server_round}.safetensors"
+            save_file(
+                parameters_dict,
+                str(save_path),
+                metadata={"round": str(server_round), "metrics": json.dumps(metrics)},
             )
             print(f"\nSaved aggregated model for round {server_round} to {save_path}")
 
-            # Save the latest model for inference
-            latest_path = self.save_dir / "model_latest.pt"
-            torch.save(
-                {
-                    "round": server_round,
-                    "model_state_dict": parameters_dict,
-                    "metrics": metrics,
-                },
-                latest_path,
-            )
+            # Point the latest model for inference at the same file instead of writing it
+            # twice. Link under a temporary name and rename it over the old link so readers
+            # never see a missing or half-written file
+            latest_path = self.save_dir / "model_latest.safetensors"
+            tmp_path = latest_path.with_suffix(".tmp")
+            tmp_path.unlink(missing_ok=True)
+            try:
+                os.link(save_path, tmp_path)
+            except OSError:
+                # Filesystems without hard links (e.g. FAT on a USB drive)
+                shutil.copyfile(save_path, tmp_path)
+            os.replace(tmp_path, latest_path)
             print(f"Saved latest model to {latest_path}")
 
             return aggregated_parameters, metrics